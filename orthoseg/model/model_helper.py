@@ -3,13 +3,16 @@
 Module with helper functions regarding (keras) models.
 """
 
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import lru_cache
 import json
 import logging
+import math
+import os
 from pathlib import Path
-import shutil
-from typing import List, Optional
+import re
+from typing import List, Optional, Union
 
-import pandas as pd
 from keras import callbacks
 
 # -------------------------------------------------------------
@@ -19,6 +22,17 @@ from keras import callbacks
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.INFO)
 
+# Suffixes of the file/dir names that can contain models
+_MODEL_SUFFIXES = (".hdf5", ".h5", "_tf")
+
+# Regex to parse a model filename (without suffix), as formatted by
+# format_model_filename(): e.g. "subject_01.1.2_0.91000_10"
+_MODEL_FILENAME_RE = re.compile(
+    r"(?P<segment_subject>[^_]+)_(?P<traindata_id>\d+)"
+    r"(?:\.(?P<architecture_id>\d+)(?:\.(?P<trainparams_id>\d+))?)?"
+    r"_(?P<monitor_metric_accuracy>[^_]+)_(?P<epoch>\d+)(?=_|$)"
+)
+
 # -------------------------------------------------------------
 # The real work
 # -------------------------------------------------------------
@@ -223,6 +237,9 @@ class HyperParams:
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
 
 
+# Remark: this is a pure function, typically called with the same args during a
+# training, so cache the results.
+@lru_cache(maxsize=128)
 def format_model_basefilename(
     segment_subject: str,
     traindata_id: int,
@@ -303,56 +320,68 @@ def parse_model_filename(filepath: Path) -> Optional[dict]:
     Args
         filepath: the filepath to the model file
     """
+    return _parse_model_filename(
+        name=filepath.name, is_dir=filepath.is_dir(), path=str(filepath)
+    )
+
 
+def _parse_model_filename(name: str, is_dir: bool, path: str) -> Optional[dict]:
+    """
+    Parse a model_filename to a dict, see parse_model_filename().
+
+    Args
+        name: the file name of the model file, including suffix
+        is_dir: True if the model path is a directory
+        path: the path to the model file
+    """
     # Prepare filepath to extract info
-    if filepath.is_dir():
+    if is_dir:
         # If it is a dir, it should end on _tf
-        if not filepath.name.endswith("_tf"):
+        if not name.endswith("_tf"):
             logger.warning(
-                f"Not a valid path for a model, dir needs to end on _tf: {filepath}"
+                f"Not a valid path for a model, dir needs to end on _tf: {path}"
             )
             return None
         save_format = "tf"
-        filename = filepath.name
+        filename = name
     else:
-        filename = filepath.stem
-        if filepath.suffix in (".h5", ".hdf5"):
+        filename, dot, suffix = name.rpartition(".")
+        if dot and suffix in ("h5", "hdf5"):
             save_format = "h5"
         else:
-            logger.warning(f"Model file should have .h5 of .hdf5 as suffix: {filepath}")
+            logger.warning(f"Model file should have .h5 of .hdf5 as suffix: {path}")
             return None
 
     # Now extract the fields...
-    param_values = filename.split("_")
-    if len(param_values) < 3:
+    # Remark: the accuracy is matched loosely, as it can also be nan, inf or -inf
+    match = _MODEL_FILENAME_RE.match(filename)
+    monitor_metric_accuracy = None
+    if match is not None:
+        try:
+            monitor_metric_accuracy = float(match.group("monitor_metric_accuracy"))
+        except ValueError:
+            pass
+    if match is None or monitor_metric_accuracy is None:
         logger.warning(
-            f"Model file name nok, split('_') must result in >= 2 fields: {filepath}"
+            "Model file name nok, should be formatted as "
+            f"<subject>_<traindata_id>[.<ids>]_<accuracy>_<epoch>: {path}"
         )
+        return None
 
-    segment_subject = param_values[0]
-
-    model_info = param_values[1]
-    model_info_values = model_info.split(".")
-    traindata_id = int(model_info_values[0])
-    architecture_id = 0
-    trainparams_id = 0
-    if len(model_info_values) > 1:
-        architecture_id = int(model_info_values[1])
-        if len(model_info_values) > 2:
-            trainparams_id = int(model_info_values[2])
-
-    monitor_metric_accuracy = float(param_values[2])
-    epoch = int(param_values[3])
+    segment_subject = match.group("segment_subject")
+    traindata_id = int(match.group("traindata_id"))
+    architecture_id = int(match.group("architecture_id") or 0)
+    trainparams_id = int(match.group("trainparams_id") or 0)
+    epoch = int(match.group("epoch"))
 
-    basefilename = format_model_basefilename(
-        segment_subject=segment_subject,
-        traindata_id=traindata_id,
-        architecture_id=architecture_id,
-        trainparams_id=trainparams_id,
-    )
+    # Format the basefilename inline, the same way as format_model_basefilename(),
+    # as this is called for every model file.
+    basefilename = f"{segment_subject}_{traindata_id:02d}"
+    if architecture_id > 0 or trainparams_id > 0:
+        basefilename = f"{basefilename}.{architecture_id}.{trainparams_id}"
 
     return {
-        "filepath": filepath,
+        "filepath": Path(path),
         "filename": filename,
         "basefilename": basefilename,
         "segment_subject": segment_subject,
@@ -374,7 +403,7 @@ def get_models(
 ) -> List[dict]:
     """
     Return the list of models in the model_dir passed. It is returned as a
-    dataframe with the columns as returned in parse_model_filename()
+    list of dicts with the keys as returned in parse_model_filename()
 
     Args
         model_dir (Path): dir containing the models
@@ -384,47 +413,71 @@ def get_models(
         trainparams_id (int, optional): only models with this hyperparams version
     """
 
-    # List models
-    model_paths = []
-    model_paths.extend(model_dir.glob("*.hdf5"))
-    model_paths.extend(model_dir.glob("*.h5"))
-    model_paths.extend(model_dir.glob("*_tf"))
+    if not model_dir.exists():
+        return []
 
-    # Loop through all models and extract necessary info...
+    # List models: use a single scandir pass instead of one glob per suffix and
+    # extract the necessary info...
     model_info_list = []
-    for model_path in model_paths:
-        model_info = parse_model_filename(model_path)
-        if model_info is not None:
-            model_info_list.append(model_info)
+    with os.scandir(model_dir) as entries:
+        for entry in entries:
+            # Pre-filter on the name, so is_dir() is only called for candidates
+            if not entry.name.endswith(_MODEL_SUFFIXES):
+                continue
+
+            # Pass the DirEntry info, so no extra stat calls are needed
+            model_info = _parse_model_filename(
+                name=entry.name, is_dir=entry.is_dir(), path=entry.path
+            )
+            if model_info is not None:
+                model_info_list.append(model_info)
 
     # Filter, if filters provided
-    if len(model_info_list) > 0:
-        if segment_subject is not None:
-            model_info_list = [
-                model_info
-                for model_info in model_info_list
-                if model_info["segment_subject"] == segment_subject
-            ]
-        if traindata_id is not None:
-            model_info_list = [
-                model_info
-                for model_info in model_info_list
-                if model_info["traindata_id"] == traindata_id
-            ]
-        if trainparams_id is not None:
-            model_info_list = [
-                model_info
-                for model_info in model_info_list
-                if model_info["trainparams_id"] == trainparams_id
-            ]
-        if architecture_id is not None:
-            model_info_list = [
-                model_info
-                for model_info in model_info_list
-                if model_info["architecture_id"] == architecture_id
-            ]
+    return _filter_models(
+        model_info_list,
+        segment_subject=segment_subject,
+        traindata_id=traindata_id,
+        architecture_id=architecture_id,
+        trainparams_id=trainparams_id,
+    )
 
-    return model_info_list
+
+def _filter_models(
+    model_info_list: List[dict],
+    segment_subject: Optional[str] = None,
+    traindata_id: Optional[int] = None,
+    architecture_id: Optional[int] = None,
+    trainparams_id: Optional[int] = None,
+) -> List[dict]:
+    """
+    Filter the list of models passed on the properties specified.
+
+    Args
+        model_info_list (List[dict]): the models as returned by get_models()
+        segment_subject (str, optional): only models with this the segment subject
+        traindata_id (int, optional): only models with this traindata version
+        architecture_id (int, optional): only models with this this architecture_id
+        trainparams_id (int, optional): only models with this hyperparams version
+    """
+    # Only keep the filters specified, so all can be checked in a single pass
+    filters = [
+        (key, value)
+        for key, value in (
+            ("segment_subject", segment_subject),
+            ("traindata_id", traindata_id),
+            ("architecture_id", architecture_id),
+            ("trainparams_id", trainparams_id),
+        )
+        if value is not None
+    ]
+    if len(filters) == 0:
+        return model_info_list
+
+    return [
+        model_info
+        for model_info in model_info_list
+        if all(model_info[key] == value for key, value in filters)
+    ]
 
 
 def get_best_model(
@@ -433,6 +486,7 @@ def get_best_model(
     traindata_id: Optional[int] = None,
     architecture_id: Optional[int] = None,
     trainparams_id: Optional[int] = None,
+    models: Optional[List[dict]] = None,
 ) -> Optional[dict]:
     """
     Get the properties of the model with the highest combined accuracy for the highest
@@ -447,48 +501,51 @@ def get_best_model(
         traindata_id (int, optional): only models with this train data id
         architecture_id (int, optional): only models with this the architecture_id
         trainparams_id (int, optional): only models with this hyperparams id
+        models (List[dict], optional): the models to choose from, as returned by
+            get_models(). If None, the models in model_dir are listed. Defaults to
+            None.
 
     Returns
         A dictionary with the info of the best model, or None if no model was found
     """
     # Get list of existing models for this train dataset
-    model_info_list = get_models(
-        model_dir=model_dir,
-        segment_subject=segment_subject,
-        traindata_id=traindata_id,
-        architecture_id=architecture_id,
-        trainparams_id=trainparams_id,
-    )
+    if models is None:
+        model_info_list = get_models(
+            model_dir=model_dir,
+            segment_subject=segment_subject,
+            traindata_id=traindata_id,
+            architecture_id=architecture_id,
+            trainparams_id=trainparams_id,
+        )
+    else:
+        model_info_list = _filter_models(
+            models,
+            segment_subject=segment_subject,
+            traindata_id=traindata_id,
+            architecture_id=architecture_id,
+            trainparams_id=trainparams_id,
+        )
 
     # If nothing found, return None
     if len(model_info_list) == 0:
         return None
 
     # If no traindata_id provided, find highest traindata id
-    max_traindata_id = -1
-    for model_info in model_info_list:
-        if model_info["traindata_id"] > max_traindata_id:
-            max_traindata_id = model_info["traindata_id"]
-
-    # Get the list of newest model
-    newest_model_info_list = [
-        model_info
-        for model_info in model_info_list
-        if model_info["traindata_id"] == max_traindata_id
-    ]
-
-    # If only one result, return it
-    if len(newest_model_info_list) == 1:
-        return newest_model_info_list[0]
-    else:
-        max_monitor_metric_accuracy = -1
-        max_monitor_metric_accuracy_idx = -1
-        for model_info_idx, model_info in enumerate(model_info_list):
-            if model_info["monitor_metric_accuracy"] > max_monitor_metric_accuracy:
-                max_monitor_metric_accuracy = model_info["monitor_metric_accuracy"]
-                max_monitor_metric_accuracy_idx = model_info_idx
-
-        return model_info_list[max_monitor_metric_accuracy_idx]
+    max_traindata_id = max(model_info["traindata_id"] for model_info in model_info_list)
+
+    # Return the model with the highest accuracy for the newest traindata id
+    # Remark: nan accuracies are sorted lowest, as comparisons with nan are False
+    return max(
+        (
+            model_info
+            for model_info in model_info_list
+            if model_info["traindata_id"] == max_traindata_id
+        ),
+        key=lambda model_info: (
+            not math.isnan(model_info["monitor_metric_accuracy"]),
+            model_info["monitor_metric_accuracy"],
+        ),
+    )
 
 
 class ModelCheckpointExt(callbacks.Callback):
@@ -568,6 +625,21 @@ class ModelCheckpointExt(callbacks.Callback):
         self.verbose = verbose
         self.only_report = only_report
 
+        # Old models are removed in a background thread, so the next epoch can start
+        # while the removal is being done. The executor only lives during a training.
+        self._cleanup_executor: Optional[ThreadPoolExecutor] = None
+        self._cleanup_future: Optional[Future] = None
+
+    def _wait_for_cleanup(self):
+        if self._cleanup_future is not None:
+            # Raises the exception if the cleanup failed
+            self._cleanup_future.result()
+            self._cleanup_future = None
+
+    def on_train_begin(self, logs=None):
+        if self._cleanup_executor is None:
+            self._cleanup_executor = ThreadPoolExecutor(max_workers=1)
+
     def on_epoch_end(self, epoch, logs={}):
         logger.debug(f"Start in callback on_epoch_begin, logs contains: {logs}")
 
@@ -581,7 +653,9 @@ class ModelCheckpointExt(callbacks.Callback):
             new_model_monitor_value = eval(monitor_metric_formatted, {}, {})
 
         # Now we can save and clean models
-        save_and_clean_models(
+        # Remark: the previous cleanup must be ready before listing the models again
+        self._wait_for_cleanup()
+        self._cleanup_future = save_and_clean_models(
             model_save_dir=self.model_save_dir,
             segment_subject=self.segment_subject,
             traindata_id=self.traindata_id,
@@ -599,8 +673,17 @@ class ModelCheckpointExt(callbacks.Callback):
             model_template_for_save=self.model_template_for_save,
             verbose=self.verbose,
             only_report=self.only_report,
+            cleanup_executor=self._cleanup_executor,
         )
 
+    def on_train_end(self, logs=None):
+        try:
+            self._wait_for_cleanup()
+        finally:
+            if self._cleanup_executor is not None:
+                self._cleanup_executor.shutdown(wait=True)
+                self._cleanup_executor = None
+
 
 def save_and_clean_models(
     model_save_dir: Path,
@@ -621,7 +704,8 @@ def save_and_clean_models(
     verbose: bool = True,
     debug: bool = False,
     only_report: bool = False,
-):
+    cleanup_executor: Optional[Executor] = None,
+) -> Optional[Future]:
     """
     Save the new model if it is good enough... and cleanup existing models
     if they are worse than the new or other existing models.
@@ -653,9 +737,14 @@ def save_and_clean_models(
         verbose (bool, optional): report the best model after save and cleanup
         debug (bool, optional): write debug logging
         only_report (bool, optional): only report which models would be cleaned up
+        cleanup_executor (Executor, optional): if specified, the models that aren't
+            kept are removed in the background using this executor. The new model is
+            always saved before returning.
+
+    Returns
+        The Future of the cleanup if it was submitted to cleanup_executor, otherwise
+        None.
     """
-    # TODO: add option to specify minimum accuracy/iou score before saving to speed up,
-    # because saving takes quite some time!
     # Check validaty of input
     monitor_metric_mode_values = ["min", "max"]
     if monitor_metric_mode not in monitor_metric_mode_values:
@@ -680,6 +769,7 @@ def save_and_clean_models(
 
     # If there is a new model passed as param, add it to the list
     new_model_path = None
+    new_model_info = None
     new_model_monitor_accuracy = None
     if new_model is not None:
 
@@ -698,22 +788,42 @@ def save_and_clean_models(
         else:
             new_model_monitor_accuracy = 1 - new_model_monitor_value
 
-        new_model_filename = format_model_filename(
-            segment_subject=segment_subject,
-            traindata_id=traindata_id,
-            architecture_id=architecture_id,
-            trainparams_id=trainparams_id,
-            monitor_metric_accuracy=new_model_monitor_accuracy,
-            epoch=new_model_epoch,
-            save_format=save_format,
-        )
-        new_model_path = Path(model_save_dir) / new_model_filename
-
-        # Append model to the retrieved models...
-        model_info_list.append(
-            {
-                "filepath": str(new_model_path),
-                "filename": new_model_filename,
+        # If only the best model is kept and an existing model is at least as good,
+        # the new model won't be kept anyway, so skip it: saving takes quite some time
+        if save_best_only and any(
+            model_info["monitor_metric_accuracy"] >= new_model_monitor_accuracy
+            for model_info in model_info_list
+        ):
+            logger.debug(
+                f"New model not saved, accuracy {new_model_monitor_accuracy} is not "
+                "better than the existing models"
+            )
+            new_model = None
+        else:
+            new_model_filename = format_model_filename(
+                segment_subject=segment_subject,
+                traindata_id=traindata_id,
+                architecture_id=architecture_id,
+                trainparams_id=trainparams_id,
+                monitor_metric_accuracy=new_model_monitor_accuracy,
+                epoch=new_model_epoch,
+                save_format=save_format,
+            )
+            new_model_path = Path(model_save_dir) / new_model_filename
+
+            # Append model to the retrieved models, with the same properties as
+            # returned by parse_model_filename()
+            new_model_info = {
+                "filepath": new_model_path,
+                "filename": (
+                    new_model_path.stem if save_format == "h5" else new_model_filename
+                ),
+                "basefilename": format_model_basefilename(
+                    segment_subject=segment_subject,
+                    traindata_id=traindata_id,
+                    architecture_id=architecture_id,
+                    trainparams_id=trainparams_id,
+                ),
                 "segment_subject": segment_subject,
                 "traindata_id": traindata_id,
                 "architecture_id": architecture_id,
@@ -722,47 +832,53 @@ def save_and_clean_models(
                 "epoch": new_model_epoch,
                 "save_format": save_format,
             }
-        )
+            model_info_list.append(new_model_info)
 
     # Loop through all existing models
     # Remark: the list is sorted descending before iterating it, this way new
     # modelss are saved bevore deleting the previous best one(s)
-    model_info_df = pd.DataFrame(model_info_list)
-    model_info_sorted_df = model_info_df.sort_values(
-        by="monitor_metric_accuracy", ascending=False
+    model_info_sorted_list = sorted(
+        model_info_list,
+        key=lambda model_info: model_info["monitor_metric_accuracy"],
+        reverse=True,
     )
-    for model_info in model_info_sorted_df.itertuples(index=False):
+    remaining_model_info_list = []
+    models_to_remove = []
+    for model_info in model_info_sorted_list:
+        is_new_model = model_info is new_model_info
 
         # If only the best needs to be kept, check only on monitor_metric_accuracy...
         keep_model = True
-        better_ones_df = None
+        better_ones = None
         if save_best_only:
-            better_ones_df = model_info_df[
-                (model_info_df.filepath != model_info.filepath)
-                & (
-                    model_info_df.monitor_metric_accuracy
-                    >= model_info.monitor_metric_accuracy
-                )
+            better_ones = [
+                other
+                for other in model_info_list
+                if other["filepath"] != model_info["filepath"]
+                and other["monitor_metric_accuracy"]
+                >= model_info["monitor_metric_accuracy"]
             ]
-            if len(better_ones_df) > 0:
+            if len(better_ones) > 0:
                 keep_model = False
 
         # If model is (relatively) ok, keep it
         if keep_model is True:
-            logger.debug(f"KEEP {model_info.filename}")
+            logger.debug(f"KEEP {model_info['filename']}")
+            if not is_new_model:
+                remaining_model_info_list.append(model_info)
 
             # If it is the new model that needs to be kept, keep it or save to disk
             if (
-                new_model_path is not None
+                is_new_model
+                and new_model_path is not None
                 and new_model is not None
                 and new_model_epoch is not None
                 and only_report is not True
-                and model_info.filepath == str(new_model_path)
                 and not new_model_path.exists()
             ):
                 if (
                     new_model_epoch > save_min_accuracy_ignored_epoch
-                    or model_info.monitor_metric_accuracy > save_min_accuracy
+                    or model_info["monitor_metric_accuracy"] > save_min_accuracy
                 ):
                     logger.debug("Save model start")
                     if save_weights_only:
@@ -775,6 +891,7 @@ def save_and_clean_models(
                             model_template_for_save.save(str(new_model_path))
                         else:
                             new_model.save(str(new_model_path))
+                    remaining_model_info_list.append(model_info)
                     logger.debug("Save model ready")
                 else:
                     print(
@@ -784,26 +901,35 @@ def save_and_clean_models(
         else:
             # Bad model... can be removed (or not saved)
             if only_report is True:
-                logger.debug(f"DELETE {model_info.filename}")
-            elif Path(model_info.filepath).exists() is True:
-                logger.debug(f"DELETE {model_info.filename}")
-                if Path(model_info.filepath).is_dir() is True:
-                    shutil.rmtree(model_info.filepath)
-                else:
-                    Path(model_info.filepath).unlink()
-
-            if debug is True and better_ones_df is not None:
-                print(f"Better one(s) found for{model_info.filename}:")
-                for better_one in better_ones_df.itertuples(index=False):
-                    print(f"  {better_one.filename}")
+                logger.debug(f"DELETE {model_info['filename']}")
+                if not is_new_model:
+                    remaining_model_info_list.append(model_info)
+            elif not is_new_model or model_info["filepath"].exists():
+                # The models listed by get_models() exist, only the new one might not
+                models_to_remove.append(model_info)
+
+            if debug is True and better_ones is not None:
+                print(f"Better one(s) found for{model_info['filename']}:")
+                for better_one in better_ones:
+                    print(f"  {better_one['filename']}")
+
+    # Remove the models that aren't kept, in the background if an executor is passed
+    cleanup_future = None
+    if len(models_to_remove) > 0:
+        if cleanup_executor is not None:
+            cleanup_future = cleanup_executor.submit(_remove_models, models_to_remove)
+        else:
+            _remove_models(models_to_remove)
 
     if verbose is True or debug is True:
+        # Reuse the remaining models instead of listing the model dir again
         best_model = get_best_model(
             model_dir=model_save_dir,
             segment_subject=segment_subject,
             traindata_id=traindata_id,
             architecture_id=architecture_id,
             trainparams_id=trainparams_id,
+            models=remaining_model_info_list,
         )
         if best_model is not None:
             logger.info(
@@ -811,3 +937,39 @@ def save_and_clean_models(
                 f"monitor_metric_accuracy: {best_model['monitor_metric_accuracy']}, "
                 f"epoch: {best_model['epoch']}"
             )
+
+    return cleanup_future
+
+
+def _remove_models(models: List[dict]):
+    """
+    Remove the model files/dirs of the models passed.
+
+    Args
+        models (List[dict]): the models to remove, as returned by get_models()
+    """
+    for model_info in models:
+        logger.debug(f"DELETE {model_info['filename']}")
+        # Models in tf format are dirs, see _parse_model_filename()
+        if model_info["save_format"] == "tf":
+            _rmtree(model_info["filepath"])
+        else:
+            model_info["filepath"].unlink(missing_ok=True)
+
+
+def _rmtree(path: Union[str, os.PathLike]):
+    """
+    Remove a directory with all its contents.
+
+    Simpler than shutil.rmtree, for the small directory trees of tf savedmodels.
+
+    Args
+        path (PathLike): the directory to remove
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
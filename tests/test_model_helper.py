@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for functionalities in orthoseg.model.model_helper.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import math
+from pathlib import Path
+import sys
+import time
+
+import pytest
+
+# Add path so the local orthoseg packages are found
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from orthoseg.model import model_helper
+
+
+class _ModelStub:
+    """Minimal stand-in for a keras model, only supporting save()."""
+
+    def save(self, filepath: str):
+        Path(filepath).touch()
+
+
+def _create_model_files(model_dir: Path, filenames: list):
+    model_dir.mkdir(parents=True, exist_ok=True)
+    for filename in filenames:
+        if filename.endswith("_tf"):
+            (model_dir / filename).mkdir()
+            (model_dir / filename / "saved_model.pb").touch()
+        else:
+            (model_dir / filename).touch()
+
+
+def test_get_models(tmp_path):
+    model_dir = tmp_path / "models"
+    _create_model_files(
+        model_dir,
+        [
+            "footballfields_01_0.91000_10.hdf5",
+            "footballfields_01_0.92000_11.h5",
+            "footballfields_02_0.93000_5_tf",
+            "footballfields_02.1.2_0.94000_6.hdf5",
+            "footballfields_01_hyperparams.json",
+            "footballfields_01_model.json",
+        ],
+    )
+
+    # Without filters, all models should be returned
+    models = model_helper.get_models(model_dir)
+    assert len(models) == 4
+    assert all(isinstance(model["filepath"], Path) for model in models)
+
+    # With filters
+    models = model_helper.get_models(model_dir, traindata_id=2)
+    assert len(models) == 2
+    models = model_helper.get_models(
+        model_dir, traindata_id=2, architecture_id=1, trainparams_id=2
+    )
+    assert len(models) == 1
+    assert models[0]["filename"] == "footballfields_02.1.2_0.94000_6"
+    assert models[0]["basefilename"] == "footballfields_02.1.2"
+
+
+def test_get_models_nonexisting_dir(tmp_path):
+    models = model_helper.get_models(tmp_path / "nonexisting")
+    assert models == []
+
+
+def test_parse_model_filename(tmp_path):
+    _create_model_files(
+        tmp_path,
+        ["footballfields_01.1.2_0.91000_10.hdf5", "footballfields_02_0.93000_5_tf"],
+    )
+
+    model_info = model_helper.parse_model_filename(
+        tmp_path / "footballfields_01.1.2_0.91000_10.hdf5"
+    )
+    assert model_info is not None
+    assert model_info["filepath"] == tmp_path / "footballfields_01.1.2_0.91000_10.hdf5"
+    assert model_info["filename"] == "footballfields_01.1.2_0.91000_10"
+    assert model_info["basefilename"] == "footballfields_01.1.2"
+    assert model_info["segment_subject"] == "footballfields"
+    assert model_info["traindata_id"] == 1
+    assert model_info["architecture_id"] == 1
+    assert model_info["trainparams_id"] == 2
+    assert model_info["monitor_metric_accuracy"] == 0.91
+    assert model_info["epoch"] == 10
+    assert model_info["save_format"] == "h5"
+
+    model_info = model_helper.parse_model_filename(
+        tmp_path / "footballfields_02_0.93000_5_tf"
+    )
+    assert model_info is not None
+    assert model_info["filename"] == "footballfields_02_0.93000_5_tf"
+    assert model_info["basefilename"] == "footballfields_02"
+    assert model_info["epoch"] == 5
+    assert model_info["save_format"] == "tf"
+
+    # The accuracy can also be nan or (-)inf if the loss diverges
+    for accuracy in [float("nan"), float("inf"), float("-inf")]:
+        filename = model_helper.format_model_filename(
+            segment_subject="footballfields",
+            traindata_id=1,
+            architecture_id=0,
+            trainparams_id=0,
+            monitor_metric_accuracy=accuracy,
+            epoch=3,
+            save_format="h5",
+        )
+        model_info = model_helper.parse_model_filename(tmp_path / filename)
+        assert model_info is not None
+        assert model_info["epoch"] == 3
+        if math.isnan(accuracy):
+            assert math.isnan(model_info["monitor_metric_accuracy"])
+        else:
+            assert model_info["monitor_metric_accuracy"] == accuracy
+
+
+def test_parse_model_filename_invalid(tmp_path):
+    model_info = model_helper.parse_model_filename(
+        tmp_path / "footballfields_01_0.91000_10.json"
+    )
+    assert model_info is None
+
+
+def test_save_and_clean_models(tmp_path):
+    _create_model_files(
+        tmp_path,
+        [
+            "footballfields_01_0.91000_10.hdf5",
+            "footballfields_01_0.93000_12.hdf5",
+            "footballfields_01_0.92000_11_tf",
+            "footballfields_02_0.90000_1.hdf5",
+        ],
+    )
+
+    model_helper.save_and_clean_models(
+        model_save_dir=tmp_path,
+        segment_subject="footballfields",
+        traindata_id=1,
+        architecture_id=0,
+        trainparams_id=0,
+        monitor_metric_mode="max",
+        save_best_only=True,
+    )
+
+    # Only the best model of traindata_id 1 should be kept, other ids are untouched
+    models = model_helper.get_models(tmp_path)
+    filenames = sorted(model["filename"] for model in models)
+    assert filenames == [
+        "footballfields_01_0.93000_12",
+        "footballfields_02_0.90000_1",
+    ]
+
+
+def test_get_best_model(tmp_path):
+    _create_model_files(
+        tmp_path,
+        [
+            "footballfields_01_0.91000_10.hdf5",
+            "footballfields_01_0.93000_12.hdf5",
+            "footballfields_01.1.0_0.95000_3.hdf5",
+        ],
+    )
+
+    best_model = model_helper.get_best_model(tmp_path, architecture_id=0)
+    assert best_model is not None
+    assert best_model["filename"] == "footballfields_01_0.93000_12"
+
+    # If a list of models is passed, the model dir isn't listed again
+    models = model_helper.get_models(tmp_path)
+    best_model = model_helper.get_best_model(
+        tmp_path / "nonexisting", architecture_id=1, models=models
+    )
+    assert best_model is not None
+    assert best_model["filename"] == "footballfields_01.1.0_0.95000_3"
+
+    # A model with a nan accuracy should never be the best one, regardless of the
+    # order of the models
+    _create_model_files(tmp_path, ["footballfields_01_nan_101.hdf5"])
+    models = model_helper.get_models(tmp_path, architecture_id=0)
+    models = sorted(
+        models, key=lambda model: not math.isnan(model["monitor_metric_accuracy"])
+    )
+    assert math.isnan(models[0]["monitor_metric_accuracy"])
+    best_model = model_helper.get_best_model(tmp_path, models=models)
+    assert best_model is not None
+    assert best_model["filename"] == "footballfields_01_0.93000_12"
+
+
+def test_get_best_model_no_models(tmp_path):
+    assert model_helper.get_best_model(tmp_path) is None
+
+
+def test_save_and_clean_models_new_model(tmp_path):
+    _create_model_files(
+        tmp_path,
+        ["footballfields_01_0.91000_10.hdf5", "footballfields_01_0.93000_12.hdf5"],
+    )
+
+    model_helper.save_and_clean_models(
+        model_save_dir=tmp_path,
+        segment_subject="footballfields",
+        traindata_id=1,
+        architecture_id=0,
+        trainparams_id=0,
+        monitor_metric_mode="max",
+        new_model=_ModelStub(),
+        new_model_monitor_value=0.95,
+        new_model_epoch=13,
+        save_best_only=True,
+    )
+
+    # The new model is better, so it should be saved and the others removed
+    models = model_helper.get_models(tmp_path)
+    assert len(models) == 1
+    assert models[0]["filename"] == "footballfields_01_0.95000_13"
+    assert models[0]["epoch"] == 13
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "footballfields_01.hdf5",
+        "footballfields_01_0.91000.hdf5",
+        "footballfields_xx_0.91000_10.hdf5",
+        "footballfields_01_0.91000_xx.hdf5",
+        "footballfields_01_xx_10.hdf5",
+    ],
+)
+def test_parse_model_filename_nok(tmp_path, filename: str):
+    model_info = model_helper.parse_model_filename(tmp_path / filename)
+    assert model_info is None
+
+
+@pytest.mark.parametrize(
+    "filename, expected_basefilename",
+    [
+        ("footballfields_1_0.91000_10.hdf5", "footballfields_01"),
+        ("footballfields_01.0.0_0.91000_10.hdf5", "footballfields_01"),
+        ("footballfields_01.2_0.91000_10.hdf5", "footballfields_01.2.0"),
+        ("footballfields_01.0.3_0.91000_10.hdf5", "footballfields_01.0.3"),
+    ],
+)
+def test_parse_model_filename_basefilename(
+    tmp_path, filename: str, expected_basefilename: str
+):
+    # The basefilename should always be formatted as by format_model_basefilename
+    model_info = model_helper.parse_model_filename(tmp_path / filename)
+    assert model_info is not None
+    assert model_info["basefilename"] == expected_basefilename
+    assert model_info["basefilename"] == model_helper.format_model_basefilename(
+        segment_subject=model_info["segment_subject"],
+        traindata_id=model_info["traindata_id"],
+        architecture_id=model_info["architecture_id"],
+        trainparams_id=model_info["trainparams_id"],
+    )
+
+
+def test_get_best_model_newest_traindata(tmp_path):
+    _create_model_files(
+        tmp_path,
+        [
+            "footballfields_01_0.99000_10.hdf5",
+            "footballfields_02_0.90000_3.hdf5",
+            "footballfields_02_0.91000_4.hdf5",
+        ],
+    )
+
+    # The best model of the newest traindata id should be returned, even if a
+    # model of an older traindata id has a higher accuracy
+    best_model = model_helper.get_best_model(tmp_path)
+    assert best_model is not None
+    assert best_model["filename"] == "footballfields_02_0.91000_4"
+
+
+@pytest.mark.parametrize("new_model_monitor_value", [0.92, 0.93])
+def test_save_and_clean_models_new_model_not_better(
+    tmp_path, new_model_monitor_value: float
+):
+    _create_model_files(tmp_path, ["footballfields_01_0.93000_12.hdf5"])
+
+    model_helper.save_and_clean_models(
+        model_save_dir=tmp_path,
+        segment_subject="footballfields",
+        traindata_id=1,
+        architecture_id=0,
+        trainparams_id=0,
+        monitor_metric_mode="max",
+        new_model=_ModelStub(),
+        new_model_monitor_value=new_model_monitor_value,
+        new_model_epoch=13,
+        save_best_only=True,
+    )
+
+    # The new model isn't better, so it isn't saved and the existing one is kept
+    models = model_helper.get_models(tmp_path)
+    assert len(models) == 1
+    assert models[0]["filename"] == "footballfields_01_0.93000_12"
+
+
+def test_save_and_clean_models_cleanup_executor(tmp_path):
+    _create_model_files(
+        tmp_path,
+        ["footballfields_01_0.91000_10.hdf5", "footballfields_01_0.92000_11_tf"],
+    )
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        cleanup_future = model_helper.save_and_clean_models(
+            model_save_dir=tmp_path,
+            segment_subject="footballfields",
+            traindata_id=1,
+            architecture_id=0,
+            trainparams_id=0,
+            monitor_metric_mode="max",
+            new_model=_ModelStub(),
+            new_model_monitor_value=0.95,
+            new_model_epoch=13,
+            save_best_only=True,
+            cleanup_executor=executor,
+        )
+
+        # The new model is saved synchronously, the cleanup in the background
+        assert (tmp_path / "footballfields_01_0.95000_13.hdf5").exists()
+        assert cleanup_future is not None
+        cleanup_future.result()
+
+    models = model_helper.get_models(tmp_path)
+    assert len(models) == 1
+    assert models[0]["filename"] == "footballfields_01_0.95000_13"
+
+
+def test_rmtree(tmp_path):
+    # Create a dir structure like a tf savedmodel
+    model_dir = tmp_path / "footballfields_01_0.91000_10_tf"
+    (model_dir / "variables").mkdir(parents=True)
+    (model_dir / "assets").mkdir()
+    (model_dir / "saved_model.pb").touch()
+    (model_dir / "variables" / "variables.index").touch()
+
+    model_helper._rmtree(model_dir)
+    assert not model_dir.exists()
+    assert tmp_path.exists()
+
+
+def test_model_checkpoint_ext(tmp_path, monkeypatch):
+    _create_model_files(tmp_path, ["footballfields_01_0.91000_10.hdf5"])
+    checkpoint = model_helper.ModelCheckpointExt(
+        model_save_dir=tmp_path,
+        segment_subject="footballfields",
+        traindata_id=1,
+        architecture_id=0,
+        trainparams_id=0,
+        monitor_metric="acc",
+        monitor_metric_mode="max",
+        save_best_only=True,
+    )
+    checkpoint.set_model(_ModelStub())
+
+    # Make the cleanup slow, so it is still running when the next epoch ends
+    remove_models_orig = model_helper._remove_models
+
+    def remove_models_slow(models):
+        time.sleep(0.2)
+        remove_models_orig(models)
+
+    monkeypatch.setattr(model_helper, "_remove_models", remove_models_slow)
+
+    # The previous cleanup must be ready before the models are listed again
+    get_models_orig = model_helper.get_models
+    listed_filenames = []
+
+    def get_models_check(*args, **kwargs):
+        future = checkpoint._cleanup_future
+        assert future is None or future.done()
+        models = get_models_orig(*args, **kwargs)
+        listed_filenames.append(sorted(model["filename"] for model in models))
+        return models
+
+    monkeypatch.setattr(model_helper, "get_models", get_models_check)
+
+    checkpoint.on_train_begin()
+    checkpoint.on_epoch_end(11, logs={"acc": 0.92})
+    checkpoint.on_epoch_end(12, logs={"acc": 0.95})
+    checkpoint.on_train_end()
+
+    assert listed_filenames == [
+        ["footballfields_01_0.91000_10"],
+        ["footballfields_01_0.92000_11"],
+    ]
+    assert checkpoint._cleanup_executor is None
+    models = get_models_orig(tmp_path)
+    assert len(models) == 1
+    assert models[0]["filename"] == "footballfields_01_0.95000_12"